@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
+import asyncio
 import requests
 import json
+import functools
+import hashlib
+import itertools
 import os
+import sqlite3
 import time
-import random
+import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+import ijson
+import numpy as np
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from supabase import create_client, Client
 import openai
-from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
 
 # --- Configuration (UPDATE THESE VALUES) ---
 TYPEFORM_FORM_ID = "qedCsWYt"
@@ -17,9 +29,49 @@ TYPEFORM_URL = f"https://form.typeform.com/to/{TYPEFORM_FORM_ID}"
 # Set to True to run without a browser window
 HEADLESS = False
 
+# Number of forms filled in parallel (one browser context each)
+MAX_CONCURRENT_SUBMISSIONS = 8
+
+# Typeform DOM hooks, used to wait for questions to become ready instead of sleeping
+CURRENT_QUESTION_SELECTOR = '[data-qa~="current-question"]'
+TEXT_INPUT_SELECTOR = f'{CURRENT_QUESTION_SELECTOR} input, {CURRENT_QUESTION_SELECTOR} textarea'
+DROPDOWN_OPTION_SELECTOR = f'{CURRENT_QUESTION_SELECTOR} [role="option"]'
+START_BUTTON_SELECTOR = 'button:has-text("Start"), [data-qa="start-button"]'
+# Either the welcome screen or the first question means the form is ready
+FORM_READY_SELECTOR = f'{START_BUTTON_SELECTOR}, {CURRENT_QUESTION_SELECTOR}'
+
+# Requests the automation never needs; aborted to cut page weight.
+# Stylesheets stay allowed: the visibility-based waits need CSS to hide inactive questions.
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+BLOCKED_URL_PARTS = ("google-analytics", "googletagmanager", "segment.io")
+
+# Browser storage (localStorage) captured after the first form load and reused by
+# later contexts so they skip Typeform's cold bootstrap. Cookies are not kept, so
+# submissions don't share a Typeform respondent.
+TYPEFORM_STATE_PATH = os.path.expanduser(f"~/.cache/typeform_state/{TYPEFORM_FORM_ID}.json")
+TYPEFORM_STATE_TTL = 24 * 60 * 60  # seconds
+_state_saved = False
+
 # Define the path to your placeholder file (for file_upload fields).
 PITCH_DECK_PATH = os.path.join(os.getcwd(), "placeholder_deck.pdf")
 
+# Local cache for discovered Typeform fields, so repeated runs skip the API call.
+FIELDS_CACHE_DIR = os.path.expanduser("~/.cache/typeform_fields")
+FIELDS_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# Local cache for files downloaded from answer URLs (e.g. pitch decks shared across rows)
+UPLOADS_CACHE_DIR = os.path.expanduser("~/.cache/typeform_uploads")
+
+# GPT response cache: exact hits by hash, near-duplicate rows by embedding similarity.
+LLM_CACHE_PATH = os.path.expanduser("~/.cache/typeform_llm/cache.sqlite")
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Opt-in similarity lookup (e.g. 0.97); None reuses exact matches only.
+# WARNING: a similar hit reuses another row's whole mapping. It is only accepted when
+# the SEMANTIC_CACHE_IDENTITY_COLUMNS values match exactly, so list every column that
+# identifies the respondent, or one person's answers get submitted for another row.
+SEMANTIC_CACHE_THRESHOLD = None
+SEMANTIC_CACHE_IDENTITY_COLUMNS = ("name", "email", "company")
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -27,52 +79,257 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
+# Supabase query: columns to fetch ("*" or e.g. ["name", "email", "company"]),
+# page size, and a stable ordering column so pages don't overlap
+SUPABASE_COLUMNS = "*"
+SUPABASE_PAGE_SIZE = 1000
+SUPABASE_ORDER_COLUMN = "id"
+
 # Create Supabase Client
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # OpenAI Connection Details
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+# Random pauses between questions (anti-bot jitter); set JITTER_SEED to replay the same
+# pacing per row (each submission seeds its own generator from the seed and row index)
+def _parse_jitter_seed(value):
+    if not value:
+        return None
+    if not value.strip().isdecimal():
+        raise SystemExit(f"JITTER_SEED must be a non-negative integer, got {value!r}")
+    return int(value)
+
+JITTER_SEED = _parse_jitter_seed(os.getenv("JITTER_SEED"))
+
+# Shared HTTP session: pooled keep-alive connections with retries for Typeform and file downloads
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.3)))
+
 # --- Helpers & Core Functions ---
 
-def get_rows():
-    response = supabase.table("form_submissions").select("*").execute()
-    rows = response.data
-    return rows
+class LLMCache:
+    """
+    Two-tier cache of GPT mappings stored in SQLite.
+    Looks up the exact (model, fields, row) hash first, then (if a threshold is set)
+    the most similar cached row with the same model, fields and identity columns
+    by cosine similarity of embeddings.
+    """
+
+    def __init__(self, path: str, threshold=SEMANTIC_CACHE_THRESHOLD, embedding_model: str = EMBEDDING_MODEL):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # main() advances the mapping generator from worker threads, one call at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, scope TEXT, embedding BLOB, response TEXT)"
+        )
+        self.threshold = threshold
+        self.embedding_model = embedding_model
+        self._index = {}       # scope -> (responses, stacked embeddings matrix)
+        self._embeddings = {}  # key -> row embedding computed by get_many(), reused by put()
+
+    @staticmethod
+    def _hash(payload: dict) -> str:
+        return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)).hexdigest()
+
+    def cache_key(self, model: str, fields: list, row: dict) -> str:
+        return self._hash({"model": model, "fields": fields, "row": row})
+
+    def _scope(self, model: str, fields: list, row: dict) -> str:
+        # similar hits are only searched among rows with the same identity values
+        identity = {col: row.get(col) for col in SEMANTIC_CACHE_IDENTITY_COLUMNS}
+        return self._hash({"model": model, "fields": fields, "identity": identity})
+
+    def _embed_many(self, rows: list) -> np.ndarray:
+        """Embed all rows in one request; returns an (n, d) matrix of unit vectors."""
+        resp = openai.Embedding.create(
+            model=self.embedding_model,
+            input=[orjson.dumps(row, option=orjson.OPT_SORT_KEYS, default=str).decode() for row in rows],
+        )
+        data = sorted(resp["data"], key=lambda d: d["index"])
+        embs = np.asarray([d["embedding"] for d in data], dtype=np.float32)
+        return embs / np.linalg.norm(embs, axis=1, keepdims=True)
+
+    def _load_index(self, scope: str):
+        if scope not in self._index:
+            rows = self.conn.execute(
+                "SELECT embedding, response FROM responses WHERE scope = ? AND embedding IS NOT NULL", (scope,)
+            ).fetchall()
+            responses = [r for _, r in rows]
+            matrix = np.stack([np.frombuffer(e, dtype=np.float32) for e, _ in rows]) if rows else None
+            self._index[scope] = (responses, matrix)
+        return self._index[scope]
+
+    def get_many(self, model: str, fields: list, rows: list) -> list:
+        """Cached mapping per row, or None on a miss. Misses are embedded in a single request."""
+        results = []
+        for row in rows:
+            hit = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (self.cache_key(model, fields, row),)
+            ).fetchone()
+            results.append(orjson.loads(hit[0]) if hit else None)
+        hits = sum(r is not None for r in results)
+        if hits:
+            print(f"LLM cache: {hits} exact hit(s).")
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if self.threshold is None or not missing:
+            return results
+
+        embs = self._embed_many([rows[i] for i in missing])
+        for i, emb in zip(missing, embs):
+            row = rows[i]
+            self._embeddings[self.cache_key(model, fields, row)] = emb
+            responses, matrix = self._load_index(self._scope(model, fields, row))
+            if matrix is None:
+                continue
+            sims = matrix @ emb
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                print(f"LLM cache: similar row hit (cosine={sims[best]:.3f}).")
+                results[i] = orjson.loads(responses[best])
+        return results
+
+    def discard(self, model: str, fields: list, row: dict):
+        """Drop the pending embedding of a row that won't be put()."""
+        self._embeddings.pop(self.cache_key(model, fields, row), None)
+
+    def put(self, model: str, fields: list, row: dict, response: dict):
+        key = self.cache_key(model, fields, row)
+        scope = self._scope(model, fields, row)
+        emb = self._embeddings.pop(key, None)
+        response_json = orjson.dumps(response).decode()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, scope, embedding, response) VALUES (?, ?, ?, ?)",
+            (key, scope, emb.tobytes() if emb is not None else None, response_json),
+        )
+        self.conn.commit()
+        if emb is not None and scope in self._index:
+            responses, matrix = self._index[scope]
+            matrix = emb[None, :] if matrix is None else np.vstack([matrix, emb])
+            self._index[scope] = (responses + [response_json], matrix)
+
+llm_cache = LLMCache(LLM_CACHE_PATH)
+
+def _fetch_rows_page(columns: str, offset: int, page_size: int) -> list[dict]:
+    response = (
+        supabase.table("form_submissions")
+        .select(columns)
+        .order(SUPABASE_ORDER_COLUMN)
+        .range(offset, offset + page_size - 1)
+        .execute()
+    )
+    return response.data
 
-def get_form_fields(form_id: str) -> list[dict]:
-    """Retrieve public Typeform fields. Returns list of dicts with ref, title, type and options."""
+def get_rows(columns=SUPABASE_COLUMNS, page_size: int = SUPABASE_PAGE_SIZE):
+    """
+    Yield Supabase rows page by page until an empty page comes back. 'columns' is "*"
+    or an iterable of column names. The next page is fetched in the background while
+    the current one is consumed.
+    """
+    if not isinstance(columns, str):
+        columns = ",".join(columns)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        offset = 0
+        future = executor.submit(_fetch_rows_page, columns, offset, page_size)
+        while page := future.result():
+            # advance by what was returned: the server's max-rows may cap pages below page_size
+            offset += len(page)
+            future = executor.submit(_fetch_rows_page, columns, offset, page_size)
+            yield from page
+
+def _parse_form_fields(raw_fields) -> list[dict]:
+    """Keep only ref, title, type and choice labels from the API's field objects."""
+    fields = []
+    for f in raw_fields:
+        fields.append({
+            "ref": f.get("ref"),
+            "title": f.get("title"),
+            "type": f.get("type"),
+            "options": [
+                c.get("label")
+                for c in f.get("properties", {}).get("choices", [])
+            ] if f.get("type") in ["multiple_choice", "picture_choice"] else []
+        })
+    return fields
+
+def _load_cached_form(cache_path: str):
+    """Cached {"etag", "fields"} for a form, or None if missing, unreadable or malformed."""
+    try:
+        with open(cache_path) as fh:
+            cached = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if (
+        not isinstance(cached, dict)
+        or not isinstance(cached.get("fields"), list)
+        or not all(isinstance(f, dict) for f in cached["fields"])
+    ):
+        return None
+    return cached
+
+def _save_cached_form(cache_path: str, fields: list[dict], etag):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as fh:
+            json.dump({"etag": etag, "fields": fields}, fh)
+    except OSError as e:
+        print(f"Could not write fields cache: {e}")
+
+@functools.lru_cache(maxsize=8)
+def _fetch_form_fields(form_id: str) -> list[dict]:
+    """Fields from the local cache or the Typeform API. Raises if neither is available (not memoized)."""
     print("Step 1: Discovering public form fields via Typeform API...")
     api_url = f"https://api.typeform.com/forms/{form_id}"
+    cache_path = os.path.join(FIELDS_CACHE_DIR, f"{form_id}.json")
+    cached = _load_cached_form(cache_path)
+
+    if cached and time.time() - os.path.getmtime(cache_path) < FIELDS_CACHE_TTL:
+        print("Using cached form fields.")
+        fields = cached["fields"]
+    else:
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        try:
+            with SESSION.get(api_url, headers=headers, timeout=15, stream=True) as resp:
+                if resp.status_code == 304:
+                    # unchanged since last fetch, just refresh the TTL
+                    fields = cached["fields"]
+                    os.utime(cache_path)
+                else:
+                    resp.raise_for_status()
+                    # stream-parse only the "fields" array instead of the whole form document
+                    resp.raw.decode_content = True
+                    fields = _parse_form_fields(ijson.items(resp.raw, "fields.item"))
+                    _save_cached_form(cache_path, fields, resp.headers.get("ETag"))
+        except Exception as e:
+            if not cached:
+                raise
+            print(f"Error retrieving Typeform fields: {e}")
+            print("Falling back to stale cached form fields.")
+            fields = cached["fields"]
+
+    return fields
+
+def get_form_fields(form_id: str) -> list[dict]:
+    """Retrieve public Typeform fields. Returns list of dicts with ref, title, type and options."""
     try:
-        resp = requests.get(api_url, timeout=15)
-        resp.raise_for_status()
-        form_data = resp.json()
-        fields = []
-        for f in form_data.get("fields", []):
-            fields.append({
-                "ref": f.get("ref"),
-                "title": f.get("title"),
-                "type": f.get("type"),
-                "options": [
-                    c.get("label")
-                    for c in f.get("properties", {}).get("choices", [])
-                ] if f.get("type") in ["multiple_choice", "picture_choice"] else []
-            })
-        # print(fields)
-        
-        return fields
+        return _fetch_form_fields(form_id)
     except Exception as e:
+        # failures aren't memoized, so the next call retries the API
         print(f"Error retrieving Typeform fields: {e}")
         return []
 
-def map_row_to_typeform(fields: list, row: dict, model: str = "gpt-5"):
-    print("Step 2: Mapping Supabase row to Typeform fields using GPT...")
-    
-    prompt = f"""
-You are a smart assistant filling a Typeform using a Supabase row.
-Output ONLY a JSON object, no extra text. 
-Keys = Typeform question titles in order.
+# Static part of the GPT prompt. It goes first and is identical for every row of a
+# form, so OpenAI's automatic prompt caching can reuse the processed prefix.
+SYSTEM_PROMPT_TEMPLATE = """
+You are a smart assistant filling a Typeform using Supabase rows.
+The user message contains a JSON array of Supabase rows.
+Output ONLY a JSON object, no extra text.
+Produce one answer object per row, in the same order as the rows.
+Answer object keys = Typeform question titles in order.
 
 ### RULES ###
 1. For text, number, email, url, etc → output a realistic string or number.
@@ -87,168 +344,394 @@ Keys = Typeform question titles in order.
 5. Never output placeholders like "sa", "Tell us", "How about no?".
 
 ### TYPEFORM FIELDS (in order) ###
-{json.dumps(fields, indent=2)}
-
-### SUPABASE ROW ###
-{json.dumps(row, indent=2)}
+{fields_json}
 
 Return ONLY a JSON object in this format:
 {{
-  "Question 1 title": "value",
-  "Question 2 title": "value",
-  ...
+  "answers": [
+    {{
+      "Question 1 title": "value",
+      "Question 2 title": "value",
+      ...
+    }},
+    ...
+  ]
 }}
 """
 
-    response = openai.ChatCompletion.create(
+# System prompt per serialized fields, so the prompt always matches the fields the LLM cache keys on
+_SYSTEM_PROMPT_CACHE: dict[str, str] = {}
+
+# Reasoning models only accept the default temperature.
+DEFAULT_TEMPERATURE_MODELS = ("gpt-5", "o1", "o3", "o4")
+
+def get_system_prompt(fields: list) -> str:
+    fields_json = orjson.dumps(fields, option=orjson.OPT_INDENT_2).decode()
+    if fields_json not in _SYSTEM_PROMPT_CACHE:
+        _SYSTEM_PROMPT_CACHE[fields_json] = SYSTEM_PROMPT_TEMPLATE.format(fields_json=fields_json)
+    return _SYSTEM_PROMPT_CACHE[fields_json]
+
+def _request_answers(system_message: dict, rows: list, model: str, params: dict) -> list:
+    """Send 'rows' to GPT in one request. Raises ValueError unless it returns one answer per row."""
+    stream = openai.ChatCompletion.create(
         model=model,
-        messages=[{"role": "user", "content": prompt}]
+        messages=[
+            system_message,
+            {"role": "user", "content": f"### SUPABASE ROWS ###\n{orjson.dumps(rows, default=str).decode()}"},
+        ],
+        stream=True,
+        **params
     )
+    # accumulate the streamed completion and parse it once at the end
+    buf = bytearray()
+    for chunk in stream:
+        content = chunk["choices"][0]["delta"].get("content")
+        if content:
+            buf += content.encode()
+    answers = orjson.loads(bytes(buf)).get("answers", [])
+    if len(answers) != len(rows):
+        raise ValueError(f"GPT returned {len(answers)} answers for {len(rows)} rows")
+    return answers
+
+# Failures that retrying with fewer rows can fix (bad answer count or JSON, context
+# length exceeded). Rate-limit, auth and connection errors still stop the run.
+MAPPING_ERRORS = (ValueError, openai.error.InvalidRequestError)
+
+def map_rows_to_typeform(fields: list, rows, model: str = "gpt-5", batch_size: int = 10):
+    """
+    Yield the Typeform answers for each Supabase row, one dict per row in input order.
+    Rows missing from the cache are sent to GPT in batches of batch_size,
+    so the fields schema is processed once per batch instead of once per row.
+    A batch GPT can't answer is retried row by row; rows that still fail map to None.
+    """
+    print("Step 2: Mapping Supabase rows to Typeform fields using GPT...")
+    system_message = {"role": "system", "content": get_system_prompt(fields)}
+    params = {"response_format": {"type": "json_object"}}
+    if not model.startswith(DEFAULT_TEMPERATURE_MODELS):
+        params["temperature"] = 0
+
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, batch_size)):
+        results = llm_cache.get_many(model, fields, batch)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            try:
+                answers = _request_answers(system_message, [batch[i] for i in missing], model, params)
+            except MAPPING_ERRORS as e:
+                print(f"!!! Batch mapping failed ({e}), retrying row by row.")
+                answers = []
+                for i in missing:
+                    try:
+                        answers.extend(_request_answers(system_message, [batch[i]], model, params))
+                    except MAPPING_ERRORS as e:
+                        print(f"!!! Skipping row, mapping failed: {e}")
+                        answers.append(None)
+            for i, answer in zip(missing, answers):
+                if answer is not None:
+                    results[i] = answer
+                    llm_cache.put(model, fields, batch[i], answer)
+                else:
+                    llm_cache.discard(model, fields, batch[i])
+        yield from results
+
+def map_row_to_typeform(fields: list, row: dict, model: str = "gpt-5"):
+    return next(map_rows_to_typeform(fields, [row], model=model))
+
+# Downloaded file path per URL, so rows sharing a deck URL download it once.
+_FILE_CACHE: dict[str, str] = {}
+
+def _download_file(url: str) -> str:
+    """Download 'url' into the uploads cache (once per URL) and return the local path."""
+    if url in _FILE_CACHE:
+        return _FILE_CACHE[url]
+
+    # <sha256(url)>/<original name>: Typeform shows (and accepts) the original file name
+    url_dir = os.path.join(UPLOADS_CACHE_DIR, hashlib.sha256(url.encode()).hexdigest())
+    # the URL comes from row data via GPT: reduce the decoded name to a plain file name
+    file_name = os.path.basename(unquote(urlparse(url).path))
+    if file_name in ("", ".", "..") or "\x00" in file_name:
+        file_name = "upload"
+    file_path = os.path.join(url_dir, file_name)
+    if os.path.dirname(os.path.realpath(file_path)) != os.path.realpath(url_dir):
+        raise ValueError(f"Refusing to store download outside the uploads cache: {url}")
+    if not os.path.exists(file_path):
+        os.makedirs(url_dir, exist_ok=True)
+        tmp_file = tempfile.NamedTemporaryFile(dir=url_dir, delete=False)
+        try:
+            with tmp_file, SESSION.get(url, stream=True, timeout=30) as resp:
+                resp.raise_for_status()
+                resp.raw.decode_content = True
+                shutil.copyfileobj(resp.raw, tmp_file)
+            # atomic rename, so a concurrent download of the same URL never sees a partial file
+            os.replace(tmp_file.name, file_path)
+        except BaseException:
+            # don't leave partial downloads behind in the cache
+            os.unlink(tmp_file.name)
+            raise
+
+    _FILE_CACHE[url] = file_path
+    return file_path
+
+async def _wait_for(locator, what: str, state: str = "visible", timeout: int = 10000) -> bool:
+    """Wait for the first match of 'locator'. Logs and returns False instead of raising on timeout."""
+    try:
+        await locator.first.wait_for(state=state, timeout=timeout)
+        return True
+    except Exception:
+        print(f"⚠️ Timed out after {timeout / 1000:.0f}s waiting for {what}.")
+        return False
+
+async def _current_question(page):
+    """Handle to the question currently on screen, or None if it can't be found."""
+    try:
+        return await page.locator(CURRENT_QUESTION_SELECTOR).first.element_handle(timeout=2000)
+    except Exception:
+        print("⚠️ Current question not found, can't wait for navigation.")
+        return None
+
+async def _wait_for_question_change(page, previous, timeout: int = 10000) -> bool:
+    """Wait until 'previous' is gone or no longer the current question. Logs and returns False on timeout."""
+    try:
+        await page.wait_for_function(
+            "([el, sel]) => !el.isConnected || !el.matches(sel)",
+            arg=[previous, CURRENT_QUESTION_SELECTOR],
+            timeout=timeout,
+        )
+        return True
+    except Exception:
+        print(f"⚠️ Question didn't change within {timeout / 1000:.0f}s.")
+        return False
+    finally:
+        await previous.dispose()
+
+async def _block_heavy_requests(route):
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(part in request.url for part in BLOCKED_URL_PARTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def _safe_press_enter(page):
+    try:
+        await page.keyboard.press("Enter")
+    except Exception:
+        pass
 
-    return json.loads(response.choices[0].message["content"])
+# --- Field handlers: fill the current question; the caller presses Enter afterwards ---
 
-def fill_and_submit_form(url: str, fields: list[dict], answers: dict):
+async def _handle_text(page, answer: str):
+    answer = answer or "N/A"
+    try:
+        # set the value in one go (auto-waits for the input) instead of typing per character
+        await page.locator(TEXT_INPUT_SELECTOR).first.fill(answer, timeout=10000)
+    except Exception:
+        # input not found with our selector, type into whatever has focus
+        await page.keyboard.type(answer)
+
+# Choice index -> Typeform keyboard shortcut (0 -> a, 1 -> b, etc)
+_IDX2KEY = {str(i): chr(ord('a') + i) for i in range(26)}
+
+async def _handle_choice(page, answer: str):
+    for tok in answer.split(","):
+        tok = tok.strip()
+        if tok:
+            await page.keyboard.press(_IDX2KEY.get(tok, tok[:1].lower()))
+
+async def _handle_dropdown(page, answer: str):
+    await page.keyboard.press('Tab')
+    await _safe_press_enter(page)
+    await _wait_for(page.locator(DROPDOWN_OPTION_SELECTOR), "dropdown options")
+    # answer is a single index (1-based)
+    if answer:
+        try:
+            index = int(answer)
+        except:
+            index = 1
+        for _ in range(index):
+            await page.keyboard.press("ArrowDown")
+
+async def _handle_file(page, answer: str):
+    # download file from URL and upload
+    file_path = PITCH_DECK_PATH
+    if answer.startswith("http"):
+        # blocking download, keep it off the event loop
+        file_path = await asyncio.to_thread(_download_file, answer)
+
+    upload_input = page.locator('input[type="file"]')
+    await upload_input.set_input_files(file_path)
+    # wait for Typeform to list the uploaded file before moving on
+    await _wait_for(page.get_by_text(os.path.basename(file_path), exact=True), "uploaded file name", timeout=30000)
+    print(f"✅ Uploaded file: {file_path}")
+
+async def _handle_unknown(page, answer: str):
+    print("⚠️ Unsupported field, attempting to skip.")
+
+HANDLERS = {
+    "short_text": _handle_text,
+    "email": _handle_text,
+    "number": _handle_text,
+    "website": _handle_text,
+    "text": _handle_text,
+    "long_text": _handle_text,
+    "multiple_choice": _handle_choice,
+    "picture_choice": _handle_choice,
+    "checkboxes": _handle_choice,
+    "dropdown": _handle_dropdown,
+    "file_upload": _handle_file,
+}
+
+def compile_form(fields: list[dict]) -> tuple:
+    """
+    Precompile the form into a tuple of (handler, type, ref, title), one per field in order.
+    Unsupported field types are reported once here and skipped during submission.
+    """
+    compiled = []
+    for f in fields:
+        q_type = f.get("type", "")
+        handler = HANDLERS.get(q_type)
+        if handler is None:
+            print(f"⚠️ Unknown field type '{q_type}' (ref={f.get('ref')}), it will be skipped.")
+            handler = _handle_unknown
+        compiled.append((handler, q_type, f.get("ref"), f.get("title")))
+    return tuple(compiled)
+
+async def fill_and_submit_form(browser, url: str, compiled: tuple, answers: dict, row_index: int = 0):
     """
-    Use Playwright to open the Typeform, fill fields, and submit.
-    Dynamically inputs data from 'answers' dict.
+    Use Playwright to open the Typeform in a fresh context of 'browser', fill fields, and submit.
+    'compiled' comes from compile_form(); answers are looked up by title first, then ref.
+    'row_index' keys the jitter generator so a seeded run replays the same pacing per row.
     """
     print("Step 4: Filling and submitting the form with Playwright...")
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=HEADLESS)
-        page = browser.new_page()
+    # Resolve every answer before touching the browser
+    resolved = [
+        (handler, q_type, q_ref, str(answers.get(title) or answers.get(q_ref) or ""))
+        for handler, q_type, q_ref, title in compiled
+    ]
+    missing = [q_ref for _, _, q_ref, answer in resolved if not answer]
+    if missing:
+        print(f"⚠️ No answer for fields: {', '.join(map(str, missing))}")
+
+    global _state_saved
+    state_fresh = (
+        os.path.exists(TYPEFORM_STATE_PATH)
+        and time.time() - os.path.getmtime(TYPEFORM_STATE_PATH) < TYPEFORM_STATE_TTL
+    )
+    storage_state = TYPEFORM_STATE_PATH if state_fresh else None
+    context = await browser.new_context(storage_state=storage_state)
+    await context.route("**/*", _block_heavy_requests)
+    try:
+        page = await context.new_page()
         page.set_default_timeout(25000)
-        page.goto(url)
-        page.wait_for_load_state("networkidle")
-
-        # Try to click a start button if present
-        try:
-            start_btn = page.get_by_role("button", name="Start", exact=False)
-            if start_btn.count() > 0:
-                try:
-                    start_btn.first.click(timeout=8000)
-                    page.wait_for_timeout(700)
-                except Exception:
-                    # fallback JS
-                    try:
-                        eh = start_btn.first.element_handle()
-                        if eh:
-                            page.evaluate("(el) => el.click()", eh)
-                            page.wait_for_timeout(700)
-                    except Exception:
-                        pass
-        except Exception:
-            pass
-
-        def safe_press_enter():
+        # Typeform's analytics beacons rarely let the network go idle, so wait for the form itself
+        await page.goto(url, wait_until="domcontentloaded")
+        await page.locator(FORM_READY_SELECTOR).first.wait_for(timeout=15000)
+
+        # Save the warm state once, before answering anything, so later contexts don't resume a half-filled form
+        if storage_state is None and not _state_saved:
+            _state_saved = True
+            state = await context.storage_state()
+            state["cookies"] = []
             try:
-                page.keyboard.press("Enter")
-                time.sleep(2)
-            except Exception:
-                pass
-
-        for idx, field in enumerate(fields):
-            time.sleep(1)
-            page.wait_for_timeout(500)
-            q_type = field.get("type", "")
-            q_ref = field.get("ref")
-            provided_answer = answers.get(field.get("title")) or answers.get(q_ref)  # check by title first
-
+                os.makedirs(os.path.dirname(TYPEFORM_STATE_PATH), exist_ok=True)
+                with open(TYPEFORM_STATE_PATH, "w") as fh:
+                    json.dump(state, fh)
+            except OSError as e:
+                print(f"Could not write browser state cache: {e}")
+
+        # Click the start button if the form opens on a welcome screen
+        start_btn = page.locator(START_BUTTON_SELECTOR).first
+        if await start_btn.is_visible():
+            await start_btn.click()
+            await _wait_for(page.locator(CURRENT_QUESTION_SELECTOR), "first question")
+
+        # pre-generate the (before, after) pause for every question in one call
+        rng = np.random.default_rng(None if JITTER_SEED is None else [JITTER_SEED, row_index])
+        jitter = rng.uniform([0.6, 0.8], [1.4, 1.5], size=(len(resolved), 2))
+
+        for idx, (handler, q_type, q_ref, answer) in enumerate(resolved):
             print(f"\n→ Handling ({idx+1}): {q_type}  (ref={q_ref})")
 
-            time.sleep(random.uniform(0.6, 1.4))
+            await asyncio.sleep(jitter[idx, 0])
 
             try:
-                if q_type in ["short_text", "email", "number", "website", "text", "long_text"]:
-                    # type text
-                    answer = str(provided_answer) if provided_answer else "N/A"
-                    page.keyboard.type(answer)
-                    time.sleep(0.5)
-                    safe_press_enter()
-                
-                elif q_type in ["multiple_choice", "picture_choice", "checkboxes"]:
-                    # ensure we have a string
-                    if provided_answer is not None:
-                        ans_str = str(provided_answer)
-                        for key in ans_str.replace(" ", "").split(","):
-                            key = key.lower()
-                            # convert numeric index to letter (0 -> a, 1 -> b, etc)
-                            if key.isdigit():
-                                key = chr(int(key) + ord('a'))
-                            page.keyboard.press(key)
-                            time.sleep(0.3)
-                    time.sleep(0.5)
-                    safe_press_enter()
-
-                elif q_type == "dropdown":
-                    page.keyboard.press('Tab')
-                    time.sleep(2)
-                    safe_press_enter()
-                    time.sleep(2)
-                    # answer is a single index (1-based)
-                    if provided_answer:
-                        try:
-                            index = int(provided_answer)
-                        except:
-                            index = 1
-                        for _ in range(index):
-                            page.keyboard.press("ArrowDown")
-                            time.sleep(0.3)
-                    time.sleep(0.5)
-                    safe_press_enter()
-
-                elif q_type == "file_upload":
-                    # download file from URL and upload
-                    file_path = PITCH_DECK_PATH
-                    if provided_answer and provided_answer.startswith("http"):
-                        resp = requests.get(provided_answer)
-                        resp.raise_for_status()
-                        tmp_file = tempfile.NamedTemporaryFile(delete=False)
-                        tmp_file.write(resp.content)
-                        tmp_file.close()
-                        file_path = tmp_file.name
-
-                    upload_input = page.locator('input[type="file"]')
-                    upload_input.set_input_files(file_path)
-                    print(f"✅ Uploaded file: {file_path}")
-                    time.sleep(6)
-                    safe_press_enter()
+                current = await _current_question(page) if idx + 1 < len(resolved) else None
+                await handler(page, answer)
+                await _safe_press_enter(page)
 
-                else:
-                    print(f"⚠️ Unknown field type '{q_type}', attempting to skip.")
-                    safe_press_enter()
+                # wait for the next question to be shown
+                if current is not None:
+                    await _wait_for_question_change(page, current)
 
-                time.sleep(random.uniform(0.8, 1.5))
+                # small random pause between questions (anti-bot jitter)
+                await asyncio.sleep(jitter[idx, 1])
 
             except Exception as e:
                 print(f"!!! Exception while handling field {q_ref}: {e}")
-                safe_press_enter()
+                await _safe_press_enter(page)
 
         # Try final submission
         print("\nAttempting final submission...")
         try:
-            page.keyboard.press("Control+Enter")
+            await page.keyboard.press("Control+Enter")
             try:
-                page.wait_for_selector("text=Thank you", timeout=20000)
+                await page.wait_for_selector("text=Thank you", timeout=20000)
                 print("✅ Submission appears successful (found Thank you).")
             except Exception:
                 print("⚠️ Couldn't detect a Thank you message — submission may still have gone through.")
         except Exception as e:
             print(f"Final submission attempt raised: {e}")
 
-        browser.close()
-        print("Done.")
+    finally:
+        await context.close()
+    print("Done.")
 
 
-# --- Main Execution ---
-if __name__ == "__main__":
-    # Fetch rows from Supabase
+async def main():
+    # Stream rows from Supabase, page by page
     rows = get_rows()
     
     # Fetch Typeform fields
     fields = get_form_fields(TYPEFORM_FORM_ID)
-    
-    for index, row in enumerate(rows):
-        mapping = map_row_to_typeform(fields, row)
-        # Debug: show mapping
-        print(mapping)
-        fill_and_submit_form(TYPEFORM_URL, fields, mapping)
+    compiled = compile_form(fields)
+
+    # Lazily map rows in GPT batches; nothing is fetched or mapped until submissions pull from it
+    mappings = map_rows_to_typeform(fields, rows)
+
+    # Launch the browser once and run several submissions at a time, each in its own context
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=HEADLESS)
+        # bounded, so rows are only mapped slightly ahead of the browsers
+        queue = asyncio.Queue(maxsize=MAX_CONCURRENT_SUBMISSIONS)
+
+        async def worker():
+            while (item := await queue.get()) is not None:
+                row_index, mapping = item
+                # Debug: show mapping
+                print(mapping)
+                try:
+                    await fill_and_submit_form(browser, TYPEFORM_URL, compiled, mapping, row_index)
+                except Exception as e:
+                    print(f"!!! Submission failed: {e}")
+
+        workers = [asyncio.create_task(worker()) for _ in range(MAX_CONCURRENT_SUBMISSIONS)]
+
+        # the mapping generator blocks on Supabase/OpenAI, so advance it off the event loop
+        done = object()
+        row_index = 0
+        try:
+            while (mapping := await asyncio.to_thread(next, mappings, done)) is not done:
+                # rows whose mapping failed are skipped
+                if mapping is not None:
+                    await queue.put((row_index, mapping))
+                row_index += 1
+        finally:
+            # let queued submissions finish even if mapping raised
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        await browser.close()
+
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    asyncio.run(main())